@@ -9,8 +9,17 @@
 name = 'ckbit'
 __version__ = '1.0.0'
 
-# Pull rxn_ord, pfr, cstr, app_ea in as ckbit.<x>:
-from . import rxn_ord
-from . import pfr
-from . import cstr
-from . import app_ea
+# Pull rxn_ord, pfr, cstr, app_ea in as ckbit.<x>.  They are imported on
+# first access so that importing one submodule does not pay the import cost
+# of the others:
+import importlib as _importlib
+
+_submodules = ('rxn_ord', 'pfr', 'cstr', 'app_ea')
+
+def __getattr__(attr):
+    if attr in _submodules:
+        return _importlib.import_module('.' + attr, __name__)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, attr))
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
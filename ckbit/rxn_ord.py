@@ -3,15 +3,17 @@ ckbit.rxn_ord
 
 """
 
-import pystan
+import os
+import warnings
 from datetime import datetime
 import numpy as np
 import pickle
-from hashlib import md5
-import pandas as pd
-import arviz
-from tabulate import tabulate
-import matplotlib.pyplot as plt
+from hashlib import md5, blake2b
+#pystan, pandas, arviz, tabulate, matplotlib and the optional zstandard are
+#imported inside the functions that use them to keep this import fast
+
+#Compiled Stan models loaded during this session, keyed by (model_name, hash)
+_STAN_MODEL_CACHE = {}
 
 def write_rxn_ord_stan_code(priors=None):
     '''Writes Stan code used for reaction order estimation
@@ -40,28 +42,22 @@ def write_rxn_ord_stan_code(priors=None):
                 '  real rxn_ord;   // slope of best fit line\n' \
                '  real<lower=0> sigma;               // measurement error\n' \
                '}\n'
-    #Building the model block
-    model_block = 'model {\n' \
-                 '  sigma ~ cauchy(0, 10);\n' \
-                 '  intercept ~ normal(10,100);\n' \
-                 '  rxn_ord ~ normal(0,100);\n' \
-                 '  y ~ normal(intercept + rxn_ord * x, sigma);' \
-                 '}\n'
+    #Building the model block, user priors overwrite the default priors
+    prior_lines = {'sigma': 'sigma ~ cauchy(0, 10)',
+                   'intercept': 'intercept ~ normal(10,100)',
+                   'rxn_ord': 'rxn_ord ~ normal(0,100)'}
     if priors:
-        for i in range(len(priors)):
-            term = priors[i].split('~')[0]
-            if model_block.find(term)==-1:
-                    raise UserWarning('{}not found as a variable, cannot set' \
-                                      ' its prior'.format(term)) 
-            if priors[i].find('sigma')!=-1:
-                model_block = model_block.replace('{}~ cauchy(0, 10)'.format(\
-                                                  term),priors[i])
-            if priors[i].find('intercept')!=-1:
-                model_block = model_block.replace('{}~ normal(10,100)'.format(\
-                                                  term),priors[i])
-            if priors[i].find('rxn_ord')!=-1:
-                model_block = model_block.replace('{}~ normal(0,100)'.format(\
-                                                  term),priors[i])
+        for prior in priors:
+            term = prior.split('~')[0].strip()
+            if term not in prior_lines:
+                raise UserWarning('{} not found as a variable, cannot set' \
+                                  ' its prior'.format(term))
+            prior_lines[term] = prior.strip().rstrip(';')
+    model_block = 'model {\n' + \
+                  ''.join('  {};\n'.format(line) for line in \
+                          prior_lines.values()) + \
+                  '  y ~ normal(intercept + rxn_ord * x, sigma);' \
+                  '}\n'
     code_rxn_ord = data_block+par_block+model_block
     return code_rxn_ord
 
@@ -80,22 +76,28 @@ def rxn_ord_exp_data(filename):
             Dictionary containing reaction order data inputs for Stan code
             
     '''    
+    import pandas as pd
     #Experimental data import
-    file = pd.ExcelFile(filename)
-    data = file.parse('Data')
-    press = data.Pressure
-    rates = data.Rate
+    #Use the faster calamine reader when available, otherwise openpyxl
+    try:
+        data = pd.read_excel(filename, sheet_name='Data', engine='calamine', \
+                             usecols=['Pressure','Rate'])
+    except (ImportError, ValueError):
+        data = pd.read_excel(filename, sheet_name='Data', \
+                             usecols=['Pressure','Rate'])
+    press = data['Pressure'].to_numpy(dtype=np.float64, copy=False)
+    rates = data['Rate'].to_numpy(dtype=np.float64, copy=False)
     #Data processing
-    lnPress = np.array(np.log(press))
-    lnRates = np.array(np.log(np.absolute(rates)))
-    rxn_ord_data = {'N': np.size(lnPress),
+    lnPress = np.log(press)
+    lnRates = np.log(np.abs(rates))
+    rxn_ord_data = {'N': lnPress.shape[0],
                     'x': lnPress,
                     'y': lnRates}
     return rxn_ord_data
 
 #Code to run reaction order MCMC estimate
 def MCMC(filename, model_name='rxn_ord', priors=None,\
-         warmup=None, iters=5000, chains=2, n_jobs=1, \
+         warmup=None, iters=5000, chains=2, n_jobs=None, \
          verbose=True, seed=None, \
          trace=True, init_random=False,\
          control={'adapt_delta':0.9999, 'max_treedepth':100}, int_init=10, \
@@ -124,8 +126,15 @@ def MCMC(filename, model_name='rxn_ord', priors=None,\
         chains : int, optional
             Number of chains for MCMC sampler, Default is 2
         n_jobs : int, optional
-            Number of jobs to run in parallel for MCMC sampler, maximum is 
-            number of cores the computer has, Default is 1
+            Number of jobs to run in parallel for MCMC sampler, parallelism is
+            per chain so each job samples one chain and any jobs beyond the
+            number of chains are unused, Default is None, which sets n_jobs
+            equal to the lesser of chains and the number of cores the
+            computer has, more than one job starts worker processes that
+            re-import the calling script on Windows and Mac OS (Python 3.8+),
+            so scripts must call MCMC under an if __name__ == '__main__':
+            guard or set n_jobs=1, the pfr, cstr and app_ea MCMC functions
+            intentionally keep a default of 1
         verbose : bool, optional
             Flag to signal whether Stan intermediate output should be piped to
             terminal, Default is True
@@ -158,25 +167,28 @@ def MCMC(filename, model_name='rxn_ord', priors=None,\
         sample_vals : dict
             Dictionary of values collected by the MCMC sampler
     '''
+    import arviz
     startTime = datetime.now()
     #Process data
     rxn_ord_data = rxn_ord_exp_data(filename=filename)
-    #Write stan code
-    rxn_ord_code = write_rxn_ord_stan_code(priors=priors)
     if warmup is None:
         warmup = int(iters/2)
     elif warmup>=iters:
         raise UserWarning('\nWarmup must be less than iters\nWarmup'\
                           'Entry:{}\nIters Entry:{}'.format(warmup, iters))
-    #Compile stan model or open old one
-    sm = StanModel_cache(model_code=rxn_ord_code, model_name=model_name)
+    #Write stan code and compile stan model or open old one
+    sm, _ = _get_compiled_model(priors=priors, model_name=model_name)
     #Write initialization list
-    init_list = []
-    for i in range(chains):
-        dict_init = {'intercept':int_init, 'rxn_ord':rxn_ord_init, \
-                     'sigma':sigma_init}
-        init_list.append(dict_init)
+    dict_init = {'intercept':int_init, 'rxn_ord':rxn_ord_init, \
+                 'sigma':sigma_init}
+    init_list = [dict_init]*chains
     if init_random: init_list='random'
+    #Set parallel jobs, one job is used per chain
+    if n_jobs is None:
+        n_jobs = min(chains, os.cpu_count() or 1)
+    elif n_jobs>chains:
+        warnings.warn('n_jobs ({}) > chains ({}); extra jobs ' \
+                      'unused'.format(n_jobs, chains), stacklevel=2)
     #Run sampler
     if seed==None: seed=np.random.randint(0, 1E9)
     fit = sm.sampling(data=rxn_ord_data, warmup=warmup, iter=iters, \
@@ -276,13 +288,15 @@ def VI(filename, model_name='rxn_ord', priors=None,\
         sample_vals : dict
             Dictionary of values collected by the VI sampler
     '''
+    import pandas as pd
+    import arviz
+    from tabulate import tabulate
+    import matplotlib.pyplot as plt
     startTime = datetime.now()
     #Process data
     rxn_ord_data = rxn_ord_exp_data(filename=filename)
-    #Write stan code
-    rxn_ord_code = write_rxn_ord_stan_code(priors=priors)
-    #Compile stan model or open old one
-    sm = StanModel_cache(model_code=rxn_ord_code, model_name=model_name)
+    #Write stan code and compile stan model or open old one
+    sm, _ = _get_compiled_model(priors=priors, model_name=model_name)
     #Write initialization list
     dict_init = {'intercept':int_init, 'rxn_ord':rxn_ord_init, 'sigma':sigma_init}
     if init_random: dict_init='random'
@@ -306,18 +320,19 @@ def VI(filename, model_name='rxn_ord', priors=None,\
     rows = len(names)
     data_table = []
     for i in range(0,rows):
-        data_table.append([names[i], round(np.mean(sample_vals[i]),2), \
-                         round(np.std(sample_vals[i]),2), \
-                         round(np.quantile(sample_vals[i],0.025),2), \
-                         round(np.quantile(sample_vals[i],0.25),2), \
-                         round(np.quantile(sample_vals[i],0.5),2), \
-                         round(np.quantile(sample_vals[i],0.75),2), \
-                         round(np.quantile(sample_vals[i],0.975),2)])
+        mean_ = np.mean(sample_vals[i])
+        std_ = np.std(sample_vals[i])
+        q = np.quantile(sample_vals[i], [0.025, 0.25, 0.5, 0.75, 0.975])
+        data_table.append([names[i], round(mean_,2), round(std_,2), \
+                           *np.round(q,2).tolist()])
     print(tabulate(data_table, headers=['', 'mean', 'sd', '2.5%', '25%',
                                  '50%', '75%', '97.5%']))
-    with open(diagnostic_file, 'r') as f_ptr:
-        lines = f_ptr.readlines()
-    final_vals = lines[-1]
+    #Only the last line of the diagnostic file is needed, read from the end
+    with open(diagnostic_file, 'rb') as f_ptr:
+        f_ptr.seek(0, os.SEEK_END)
+        size = f_ptr.tell()
+        f_ptr.seek(max(0, size-4096))
+        final_vals = f_ptr.read().rstrip().splitlines()[-1].decode()
     iter_val, time_val, elbo_val = final_vals.split(',')
     if int(float(iter_val))==iters: print('The maximum number of iterations ' \
           'is reached! The algorithm may not have converged. Consider ' \
@@ -329,12 +344,22 @@ def VI(filename, model_name='rxn_ord', priors=None,\
           'is 0.2 . It is recommended to run this twice with different ' \
           'random seed initializations and ensure the ' \
           'results are consistent.'.format(elbo_val))
-    data = pd.read_csv(diagnostic_file ,skiprows=range(0,21), \
-                       names=['iters','times','elbo'])
-    iters67 = np.rint(0.67*len(data['elbo']))
-    y_range = np.mean(data['elbo'][int(iters67):len(data['elbo'])])*2
+    #Use the faster polars CSV reader when available, otherwise pandas, both
+    #frames give the ELBO and iteration columns as float64 arrays below
+    try:
+        import polars as pl
+        data = pl.read_csv(diagnostic_file, skip_rows=21, has_header=False, \
+                           schema={'iters':pl.Float64, 'times':pl.Float64, \
+                                   'elbo':pl.Float64})
+    except ImportError:
+        data = pd.read_csv(diagnostic_file, skiprows=21, \
+                           names=['iters','times','elbo'], engine='c', \
+                           dtype=np.float64)
+    elbo = data['elbo'].to_numpy()
+    iters67 = int(np.rint(0.67*elbo.shape[0]))
+    y_range = float(elbo[iters67:].mean())*2
     f, ax = plt.subplots(1)
-    ax.scatter(data['iters'],data['elbo'])
+    ax.scatter(data['iters'].to_numpy(),elbo)
     if y_range>0:
         ax.axes.set_ylim([0,y_range])
     elif y_range<0:
@@ -388,13 +413,12 @@ def MAP(filename, model_name='rxn_ord', priors=None,\
         point_estimates : dict
             Dictionary containing values corresponding to modes of posterior
     '''
+    from tabulate import tabulate
     startTime = datetime.now()
     #Process data
     rxn_ord_data = rxn_ord_exp_data(filename=filename)
-    #Write stan code
-    rxn_ord_code = write_rxn_ord_stan_code(priors=priors)
-   #Compile stan model or open old one
-    sm = StanModel_cache(model_code=rxn_ord_code, model_name=model_name)
+    #Write stan code and compile stan model or open old one
+    sm, _ = _get_compiled_model(priors=priors, model_name=model_name)
     #Write initialization list
     init_list = [{'intercept':int_init, 'rxn_ord':rxn_ord_init, \
                   'sigma':sigma_init}]
@@ -404,14 +428,39 @@ def MAP(filename, model_name='rxn_ord', priors=None,\
     point_estimates = sm.optimizing(data=rxn_ord_data, verbose=verbose, \
                                     init=init_list, seed=seed)
     #Generate and print results
-    data_table = []
-    for i in point_estimates:
-        data_table.append([i,round(float(point_estimates[i]),2)])
+    #Only scalar parameters are tabulated, array valued entries are skipped
+    scalars = [(k, float(np.asarray(v).ravel()[0])) for k, v in \
+               point_estimates.items() if np.asarray(v).size==1]
+    data_table = [[k, round(v,2)] for k, v in scalars]
     print(tabulate(data_table, headers=['Parameter', 'Estimate']))
     total_runtime = ((datetime.now() - startTime).total_seconds())/60
     print('Runtime (min): %.4f' % total_runtime)
     return point_estimates
 
+#Writes Stan code and compiles or loads the matching Stan model
+def _get_compiled_model(priors, model_name):
+    '''Writes reaction order Stan code and gets its compiled Stan model
+    
+    Parameters
+    ----------
+        priors : list of str
+            User defined prior distributions, Must have appropriate format (see
+            examples), None uses the default priors
+        model_name : str
+            Name of model, used for saving/loading compilied Stan code
+        
+    Returns
+    -------
+        sm : Stan model
+            Stan object from pystan function StanModel, shared by all
+            MCMC/VI/MAP calls with the same model_name and priors
+        rxn_ord_code : str
+            Code written in Stan syntax used for reaction order estimation
+    '''
+    rxn_ord_code = write_rxn_ord_stan_code(priors=priors)
+    sm = StanModel_cache(model_code=rxn_ord_code, model_name=model_name)
+    return sm, rxn_ord_code
+
 #Saves/loads Stan models to avoid recompilation 
 def StanModel_cache(model_code, model_name, **kwargs):
     '''Function for saving/loading compiled Stan code to avoid recompilation
@@ -426,21 +475,76 @@ def StanModel_cache(model_code, model_name, **kwargs):
     Returns
     -------
         sm : Stan model
-            Stan object from pystan function StanModel
+            Stan object from pystan function StanModel, saved compressed with
+            zstd when the zstandard package is installed
     '''
-    code_hash = md5(model_code.encode('ascii')).hexdigest()
+    import pystan
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    code_bytes = model_code.encode('ascii')
+    code_hash = blake2b(code_bytes, digest_size=16).hexdigest()
+    key = (model_name, code_hash)
+    if key in _STAN_MODEL_CACHE:
+        return _STAN_MODEL_CACHE[key]
     if model_name is None:
-        cache_fn = 'cached-model-{}.pkl'.format(code_hash)
+        cache_template = 'cached-model-{}.pkl'
     else:
-        cache_fn = 'cached-{}-{}.pkl'.format(model_name, code_hash)
+        cache_template = 'cached-{}-{{}}.pkl'.format(model_name)
+    cache_fn = cache_template.format(code_hash)
+    zst_fn = cache_fn + '.zst'
+    #Caches written before the switch to blake2b are named with an md5 hash,
+    #they are still loaded but rebuilt caches always use the blake2b name
+    load_fns = [cache_fn]
     try:
-        f = open(cache_fn, 'rb')
-    except:
+        load_fns.append(cache_template.format(md5(code_bytes).hexdigest()))
+    except ValueError:
+        #md5 is unavailable on FIPS restricted systems
+        pass
+    #Compressed caches are preferred, uncompressed caches are still loaded
+    load_fn = None
+    for fn in load_fns:
+        if zstandard is not None and os.path.exists(fn + '.zst'):
+            load_fn = fn + '.zst'
+            break
+        if os.path.exists(fn):
+            load_fn = fn
+            break
+    sm = None
+    if load_fn is not None:
+        load_errors = (pickle.UnpicklingError, EOFError)
+        if zstandard is not None:
+            load_errors += (zstandard.ZstdError,)
+        try:
+            with open(load_fn, 'rb') as f:
+                if load_fn.endswith('.zst'):
+                    with zstandard.ZstdDecompressor().stream_reader(f) as r:
+                        sm = pickle.load(r)
+                else:
+                    sm = pickle.load(f)
+        except load_errors:
+            print('Cached StanModel {} is corrupted, ' \
+                  'recompiling'.format(load_fn))
+        else:
+            print("Using cached StanModel")
+    if sm is None:
         sm = pystan.StanModel(model_code=model_code)
-        with open(cache_fn, 'wb') as f:
-            pickle.dump(sm, f)
-    else:
-        sm = pickle.load(f)
-        f.close()
-        print("Using cached StanModel")
+        save_fn = zst_fn if zstandard is not None else cache_fn
+        #Write to a temporary file first so a partial cache is never loaded
+        tmp_fn = '{}.{}.tmp'.format(save_fn, os.getpid())
+        try:
+            with open(tmp_fn, 'wb') as f:
+                if zstandard is not None:
+                    with zstandard.ZstdCompressor(level=3).stream_writer(f) \
+                            as w:
+                        pickle.dump(sm, w)
+                else:
+                    pickle.dump(sm, f)
+            os.replace(tmp_fn, save_fn)
+        except BaseException:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            raise
+    _STAN_MODEL_CACHE[key] = sm
     return sm